@@ -1,4 +1,4 @@
-from pydantic.v1 import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Optional
 import os
 from dotenv import load_dotenv
@@ -12,11 +12,14 @@ load_dotenv(BASE_DIR / ".env")
 
 class ServerConfig(BaseSettings):
     SERVER_PASSWORD: str
+    LOG_LEVEL: str = "WARNING"  # e.g. INFO to log every settings change
 
-    class Config:
-        env_file = str(BASE_DIR / ".env")
-        env_file_encoding = "utf-8"
-        case_sensitive = True
+    model_config = SettingsConfigDict(
+        env_file=str(BASE_DIR / ".env"),
+        env_file_encoding="utf-8",
+        case_sensitive=True,
+        extra="ignore",
+    )
 
 def load_server_config() -> ServerConfig:
     """Load server configuration from environment variables"""
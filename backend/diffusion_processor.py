@@ -1,7 +1,8 @@
 import re
-import numpy as np
 import time
 import os
+import threading
+import logging
 from fixed_seed import fix_seed
 import requests
 from sfast.compilers.stable_diffusion_pipeline_compiler import (
@@ -17,14 +18,59 @@ import warnings
 from compel import Compel, ReturnedEmbeddingsType
 from fixed_size_dict import FixedSizeDict
 
+logger = logging.getLogger(__name__)
+
+_BLEND_RE = re.compile(r'\("(.*?)"\s*,\s*"(.*?)"\)\.blend\(([^,]+),([^)]+)\)')
+
+
+@torch.compile(mode="reduce-overhead", fullgraph=True, dynamic=False)
+def _preprocess(images, color, tint_strength):
+    # Inductor fuses the flip, the uint8 -> fp16 normalize, the tint blend,
+    # the clamp and the channels_last layout into a single pass over the batch
+    images = images.flip(-1).to(torch.float16) / 255.0
+    images = (images * (1 - tint_strength) + color * tint_strength).clamp_(0, 1)
+    return images.contiguous(memory_format=torch.channels_last)
+
+
+def notify_webhook(webhook_url, pod_id, secret_key):
+    headers = {"X-Secret-Key": secret_key} if secret_key else {}
+
+    try:
+        response = requests.post(
+            webhook_url,
+            json={"podId": pod_id},
+            headers=headers,
+            timeout=5,
+        )
+        if response.status_code == 200:
+            print("Successfully notified webhook about readiness.")
+        else:
+            print(f"Failed to notify webhook. Status code: {response.status_code}")
+    except Exception as e:
+        print(f"Error notifying webhook: {e}")
+
 
 class DiffusionProcessor:
     def __init__(
         self, warmup=None, local_files_only=True, use_cached=False, settings=None
     ):
+        # Shapes are fixed, so let cuDNN autotune once and reuse the fastest kernels
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
+        if hasattr(torch.backends.cuda, "enable_cudnn_sdp"):
+            torch.backends.cuda.enable_cudnn_sdp(True)
+
         self.settings = settings
+        self.compiler = settings.compiler
+        self.batch_size = settings.batch_size
         self.last_tint_switch = time.time()
         self.use_first_tint = True
+        self.tint_revision = None
+        self.tint_colors = None
+        self.tint_strength = None
         print("Settings2:", settings)
 
         if use_cached:
@@ -68,19 +114,34 @@ class DiffusionProcessor:
 
         print("Model loaded")
 
-        config = CompilationConfig.Default()
-        config.enable_xformers = True
-        config.enable_triton = True
-        config.enable_cuda_graph = True
-        self.pipe = compile(self.pipe, config=config)
+        if self.compiler == "sfast":
+            config = CompilationConfig.Default()
+            config.enable_xformers = True
+            config.enable_triton = True
+            config.enable_cuda_graph = True
+            self.pipe = compile(self.pipe, config=config)
 
-        print("Model compiled")
+            print("Model compiled")
 
         self.pipe.to(device="cuda", dtype=torch.float16)
         self.pipe.set_progress_bar_config(disable=True)
 
+        # NHWC lets cuDNN pick its Tensor Core convolution kernels
+        self.pipe.unet.to(memory_format=torch.channels_last)
+        self.pipe.vae.to(memory_format=torch.channels_last)
+
         print("Model moved to GPU", flush=True)
 
+        if self.compiler == "torch":
+            # CUDA graphs need static shapes, so every batch is padded to batch_size in run()
+            self.pipe.unet = torch.compile(
+                self.pipe.unet, mode="reduce-overhead", fullgraph=True, dynamic=False
+            )
+            self.pipe.vae.decoder = torch.compile(
+                self.pipe.vae.decoder, mode="reduce-overhead", fullgraph=True, dynamic=False
+            )
+            print("Model compiled with torch.compile")
+
         self.compel = Compel(
             tokenizer=[self.pipe.tokenizer, self.pipe.tokenizer_2],
             text_encoder=[self.pipe.text_encoder, self.pipe.text_encoder_2],
@@ -88,14 +149,19 @@ class DiffusionProcessor:
             requires_pooled=[False, True],
         )
         self.prompt_cache = FixedSizeDict(32)
+        self.batch_prompt_cache = FixedSizeDict(8)
         print("Prepared compel")
 
-        self.generator = torch.manual_seed(0)
+        # Lives on the pipe device so the noise is drawn straight on the GPU
+        self.generator = torch.Generator(device="cuda").manual_seed(0)
+
+        if self.compiler == "int8":
+            self.quantize_unet()
 
         if warmup:
             print("Starting warmup")
             warmup_shape = [int(e) for e in warmup.split("x")]
-            images = np.zeros(warmup_shape, dtype=np.float32)
+            images = torch.zeros(warmup_shape, dtype=torch.uint8, device="cuda")
             for i in range(2):
                 print(f"Warmup {warmup} {i+1}/2")
                 start_time = time.time()
@@ -119,20 +185,48 @@ class DiffusionProcessor:
                 if not secret_key:
                     print("Warning: READY_WEBHOOK_SECRET_KEY not set in environment variables.")
 
-                headers = {"X-Secret-Key": secret_key} if secret_key else {}
-
-                try:
-                    response = requests.post(
-                        webhook_url, 
-                        json={"podId": pod_id},
-                        headers=headers
-                    )
-                    if response.status_code == 200:
-                        print("Successfully notified webhook about readiness.")
-                    else:
-                        print(f"Failed to notify webhook. Status code: {response.status_code}")
-                except Exception as e:
-                    print(f"Error notifying webhook: {e}")
+                # Don't let a slow webhook delay the first real inference
+                threading.Thread(
+                    target=notify_webhook,
+                    args=(webhook_url, pod_id, secret_key),
+                    daemon=True,
+                ).start()
+
+    def quantize_unet(self, calibration_steps=50):
+        """Quantize the UNet to INT8 and build fused INT8 TensorRT kernels for it.
+
+        Falls back to the fp16 UNet when ModelOpt or Torch-TensorRT are missing.
+        """
+        try:
+            import modelopt.torch.quantization as mtq
+            import torch_tensorrt
+        except ImportError as e:
+            print(f"INT8 quantization unavailable, keeping the fp16 UNet: {e}")
+            return
+
+        def calibrate(unet):
+            for _ in range(calibration_steps):
+                images = torch.randint(
+                    0, 256, (self.batch_size, 3, 512, 512), dtype=torch.uint8, device="cuda"
+                )
+                self.run(
+                    images=images,
+                    prompt=self.settings.prompt,
+                    use_compel=True,
+                    num_inference_steps=2,
+                    strength=0.7,
+                    seed=None,
+                )
+
+        print("Calibrating INT8 UNet")
+        mtq.quantize(self.pipe.unet, mtq.INT8_DEFAULT_CFG, forward_loop=calibrate)
+        # Fake-quant modules alone are slower than fp16; TensorRT fuses them into INT8 GEMMs
+        self.pipe.unet = torch_tensorrt.compile(
+            self.pipe.unet,
+            ir="torch_compile",
+            enabled_precisions={torch.int8, torch.float16},
+        )
+        print("UNet quantized to INT8")
 
     def embed_prompt(self, prompt):
         if prompt not in self.prompt_cache:
@@ -146,8 +240,9 @@ class DiffusionProcessor:
         return self.prompt_cache[prompt]
 
     def meta_embed_prompt(self, prompt):
-        pattern = r'\("(.*?)"\s*,\s*"(.*?)"\)\.blend\((.*?),(.*?)\)'
-        match = re.search(pattern, prompt)
+        if ".blend(" not in prompt:
+            return self.embed_prompt(prompt)
+        match = _BLEND_RE.search(prompt)
         if not match:
             return self.embed_prompt(prompt)
         str1, str2, t1, t2 = match.groups()
@@ -155,34 +250,39 @@ class DiffusionProcessor:
         t2 = float(t2)
         cond1, pool1 = self.embed_prompt(str1)
         cond2, pool2 = self.embed_prompt(str2)
-        cond = cond1 * t1 + cond2 * t2
-        pool = pool1 * t1 + pool2 * t2
+        cond = (cond1 * t1).add_(cond2, alpha=t2)
+        pool = (pool1 * t1).add_(pool2, alpha=t2)
         return cond, pool
 
-    def apply_tint(self, images, color):
-        # Convert color to float32 tensor and normalize to 0-1
-        color = torch.tensor(color, dtype=torch.float32, device='cuda') / 255.0
-        
-        # Print input shapes for debugging
-        print(f"Images shape before: {images.shape}, dtype: {images.dtype}")
-        
-        # Reshape color to match image dimensions (B, C, H, W format)
-        color = color.reshape(1, 3, 1, 1)
-        
-        # Convert images to float32 if they aren't already
-        images = images.to(dtype=torch.float32)
-        
-        # Print shapes for debugging
-        print(f"Images shape: {images.shape}, Color shape: {color.shape}")
-        
-        # Blend original image with tint color
-        tinted = images * (1 - self.settings.tint_strength) + color * self.settings.tint_strength
-        
-        # Convert back to original dtype
-        tinted = tinted.to(dtype=images.dtype)
-        
-        # Ensure values stay in valid range
-        return torch.clamp(tinted, 0, 1)
+    def batch_embed_prompt(self, prompt, batch_size):
+        """Return the prompt embeddings already expanded to the batch size"""
+        key = (prompt, batch_size)
+        if key not in self.batch_prompt_cache:
+            conditioning, pooled = self.meta_embed_prompt(prompt)
+            self.batch_prompt_cache[key] = (
+                conditioning.expand(batch_size, -1, -1).contiguous(),
+                pooled.expand(batch_size, -1).contiguous(),
+            )
+        return self.batch_prompt_cache[key]
+
+    def update_tint(self):
+        """Rebuild the tint tensors, only when the settings have changed"""
+        if self.tint_revision == self.settings.revision:
+            return
+        self.tint_colors = [
+            torch.tensor(color, dtype=torch.float16, device="cuda").reshape(1, 3, 1, 1) / 255.0
+            for color in (self.settings.tint_color_1, self.settings.tint_color_2)
+        ]
+        self.tint_strength = torch.tensor(
+            self.settings.tint_strength, dtype=torch.float16, device="cuda"
+        )
+        self.tint_revision = self.settings.revision
+
+    def preprocess(self, images, use_first_tint):
+        """Mirror, normalize and tint a uint8 (B, C, H, W) batch"""
+        self.update_tint()
+        color = self.tint_colors[0] if use_first_tint else self.tint_colors[1]
+        return _preprocess(images, color, self.tint_strength)
 
     def run(
         self, images, prompt, num_inference_steps, strength, use_compel=True, seed=None
@@ -193,35 +293,44 @@ class DiffusionProcessor:
             self.use_first_tint = not self.use_first_tint
             self.last_tint_switch = current_time
 
-        # Print input image shape and type for debugging
-        print(f"Input images shape: {images.shape}, dtype: {images.dtype}")
+        logger.debug("Input images shape: %s, dtype: %s", images.shape, images.dtype)
 
-        # Flip images horizontally using torch operations
-        flipped_images = torch.flip(images, dims=[-1])  # Changed to -1 since width is last dim
-        
-        # Apply current tint
-        tint_color = self.settings.tint_color_1 if self.use_first_tint else self.settings.tint_color_2
-        processed_images = self.apply_tint(flipped_images, tint_color)
+        # Flip horizontally and apply the current tint in one fused kernel
+        processed_images = self.preprocess(images, self.use_first_tint)
+
+        # Pad partial batches so the compiled graphs always see the same shape
+        num_images = len(processed_images)
+        if self.compiler == "torch" and num_images < self.batch_size:
+            padding = processed_images[-1:].expand(self.batch_size - num_images, -1, -1, -1)
+            processed_images = torch.cat([processed_images, padding])
 
         strength = min(max(1 / num_inference_steps, strength), 1)
         if seed is not None:
-            self.generator = torch.manual_seed(seed)
+            self.generator.manual_seed(seed)
         kwargs = {}
         if use_compel:
-            conditioning, pooled = self.meta_embed_prompt(prompt)
-            batch_size = len(processed_images)
-            conditioning_batch = conditioning.expand(batch_size, -1, -1)
-            pooled_batch = pooled.expand(batch_size, -1)
+            conditioning_batch, pooled_batch = self.batch_embed_prompt(
+                prompt, len(processed_images)
+            )
             kwargs["prompt_embeds"] = conditioning_batch
             kwargs["pooled_prompt_embeds"] = pooled_batch
         else:
             kwargs["prompt"] = [prompt] * len(processed_images)
-        return self.pipe(
+        latents = self.pipe(
             image=processed_images,
             generator=self.generator,
             num_inference_steps=2,
             guidance_scale=0,
             strength=0.65,
-            output_type="np",
+            output_type="latent",
             **kwargs,
         ).images
+        return self.decode(latents)[:num_images]
+
+    def decode(self, latents):
+        """Decode latents to a (B, C, H, W) fp16 batch in [0, 1]"""
+        with torch.inference_mode():
+            images = self.pipe.vae.decode(
+                latents / self.pipe.vae.config.scaling_factor, return_dict=False
+            )[0]
+        return (images / 2 + 0.5).clamp_(0, 1)
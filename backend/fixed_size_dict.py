@@ -10,6 +10,7 @@ class FixedSizeDict:
         self.cleanup()
     
     def __getitem__(self, key):
+        self.store.move_to_end(key)
         return self.store[key]
 
     def __delitem__(self, key):
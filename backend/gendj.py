@@ -1,10 +1,13 @@
 import time
+import logging
+import logging.handlers
+import atexit
 import sdl2
 import sdl2.ext
 import numpy as np
 import torch
 import torch.nn.functional as F
-from turbojpeg import TurboJPEG, TJPF_RGB
+from turbojpeg import TurboJPEG, TJPF_RGB, TJFLAG_FASTDCT, TJFLAG_FASTUPSAMPLE
 from threaded_worker import ThreadedWorker
 from diffusion_processor import DiffusionProcessor
 from settings import Settings
@@ -17,6 +20,7 @@ from image_utils import (
     get_texture_size,
 )
 import threading
+import queue
 import asyncio
 import websockets
 from threaded_worker import ThreadedWorker
@@ -28,18 +32,48 @@ import argparse
 import os
 from basicsr.archs.rrdbnet_arch import RRDBNet
 from basicsr.utils.download_util import load_file_from_url
-from realesrgan import RealESRGANer
 import json
+import functools
+from collections import deque
 
 from websockets.server import serve
 from config import load_server_config
 
+logger = logging.getLogger(__name__)
+
+
+jpeg_local = threading.local()
+
+
+def thread_jpeg():
+    """Return a TurboJPEG handle owned by the calling thread"""
+    if not hasattr(jpeg_local, "jpeg"):
+        jpeg_local.jpeg = TurboJPEG()
+    return jpeg_local.jpeg
+
+
+def decode_into(frame_data_np, dst, copy_event):
+    """Decode a JPEG straight into a pinned staging slot, off the event loop"""
+    # Wait for the previous upload from this slot before overwriting it
+    copy_event.synchronize()
+    thread_jpeg().decode(
+        frame_data_np,
+        pixel_format=TJPF_RGB,
+        flags=TJFLAG_FASTDCT | TJFLAG_FASTUPSAMPLE,
+        dst=dst,
+    )
+
+
+def encode_frame(frame):
+    return thread_jpeg().encode(frame, pixel_format=TJPF_RGB)
+
 
 class ThreadedWebsocket(ThreadedWorker):
     def __init__(self, settings):
         super().__init__(has_input=False, has_output=True)
         self.ws_port = settings.websocket_port
         self.jpeg = TurboJPEG()
+        self.decode_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="jpeg_decoder")
         self.batch = []
         self.settings_batch = []
         self.batch_size = settings.batch_size
@@ -59,45 +93,143 @@ class ThreadedWebsocket(ThreadedWorker):
         self.frame_interval = 0.25  # 250ms between frames
         self.batch_interval = self.frame_interval * settings.batch_size
         self.last_batch_time = 0
-        self.frame_buffer = []
-        self.settings_buffer = []
+        self.max_buffer_size = self.batch_size * 4  # Store up to 4 batches worth
+        self.frame_buffer = deque(maxlen=self.max_buffer_size)  # (staging slot, frame)
+        self.settings_buffer = deque(maxlen=self.max_buffer_size)  # settings revisions
+        self.settings_snapshots = {}  # revision -> settings copy
+        # Staging buffers are allocated on the first frame, once the frame size is known
+        self.frame_shape = None
+        self.host_buf = None
+        self.dev_buf = None
+        self.copy_stream = None
+        self.copy_events = None
+        self.stack_event = None
+        self.free_slots = deque()  # staging slots not held by a buffered or decoding frame
+        # Stacked batches are written into ring slots, each handed back by its consumer
+        self.batch_ring = None
+        self.free_batches = deque()  # ring slots not held by a queued or processing batch
+        self.batch_lock = threading.Lock()
+
+    def allocate_buffers(self, height, width):
+        """Allocate one pinned host slot and one device slot per buffered frame"""
+        slots = self.max_buffer_size
+        self.frame_shape = (height, width)
+        self.host_buf = torch.empty((slots, height, width, 3), dtype=torch.uint8, pin_memory=True)
+        self.dev_buf = torch.empty((slots, height, width, 3), dtype=torch.uint8, device="cuda")
+        self.copy_stream = torch.cuda.Stream()
+        self.copy_events = [torch.cuda.Event() for _ in range(slots)]
+        self.stack_event = torch.cuda.Event()
+        self.free_slots = deque(range(slots))
+        # One slot per queued batch, plus the batch being processed and the one being filled
+        with self.batch_lock:
+            self.batch_ring = torch.empty(
+                (self.max_queue_size + 2, self.batch_size, 3, height, width), dtype=torch.uint8, device="cuda"
+            )
+            self.free_batches = deque(range(len(self.batch_ring)))
+        # Frames still referencing the old buffers are no longer valid
+        self.frame_buffer.clear()
+        self.settings_buffer.clear()
+
+    def release_batch(self, ring, index):
+        """Hand a ring slot back once its batch has been processed or dropped"""
+        with self.batch_lock:
+            # Slots of a ring replaced by a resize are simply forgotten
+            if ring is self.batch_ring:
+                self.free_batches.append(index)
 
     async def process_frame(self, websocket, frame_data):
         """Process a single frame from a client"""
         try:
             frame_data_np = np.frombuffer(frame_data, dtype=np.uint8)
-            frame = self.jpeg.decode(frame_data_np, pixel_format=TJPF_RGB)
-            img = torch.from_numpy(frame).permute(2, 0, 1)
+            width, height, _, _ = self.jpeg.decode_header(frame_data_np)
+            if self.frame_shape != (height, width):
+                self.allocate_buffers(height, width)
+
+            if len(self.frame_buffer) == self.max_buffer_size:
+                # Evict the oldest frame ourselves, so its slot is free for this one
+                stale_slot, _ = self.frame_buffer.popleft()
+                self.settings_buffer.popleft()
+                self.free_slots.append(stale_slot)
+            if not self.free_slots:
+                # Every slot is held by a frame still decoding, drop this one
+                return True
+            slot = self.free_slots.popleft()
+
+            host_buf = self.host_buf
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    self.decode_pool,
+                    decode_into,
+                    frame_data_np,
+                    host_buf[slot].numpy(),
+                    self.copy_events[slot],
+                )
+            except Exception:
+                if host_buf is self.host_buf:
+                    self.free_slots.append(slot)
+                raise
+            if host_buf is not self.host_buf:
+                # The frame size changed while decoding, drop this frame
+                return True
+
+            with torch.cuda.stream(self.copy_stream):
+                # Don't overwrite a device slot the last batch stack may still be reading
+                self.copy_stream.wait_event(self.stack_event)
+                self.dev_buf[slot].copy_(self.host_buf[slot], non_blocking=True)
+                self.copy_events[slot].record()
+            img = self.dev_buf[slot].permute(2, 0, 1)
             
             current_time = time.time()
             
-            # Add to frame buffer
-            self.frame_buffer.append(img.to("cuda"))
-            self.settings_buffer.append(self.settings.copy())
-            
-            # Manage buffer size
-            max_buffer_size = self.batch_size * 4  # Store up to 4 batches worth
-            if len(self.frame_buffer) > max_buffer_size:
-                excess = len(self.frame_buffer) - max_buffer_size
-                self.frame_buffer = self.frame_buffer[excess:]
-                self.settings_buffer = self.settings_buffer[excess:]
+            # Add to frame buffer, the deques drop the oldest frames once full
+            self.frame_buffer.append((slot, img))
+            revision = self.settings.revision
+            if revision not in self.settings_snapshots:
+                self.settings_snapshots[revision] = self.settings.model_copy()
+            self.settings_buffer.append(revision)
 
             # Check if it's time to process a batch
             time_since_last_batch = current_time - self.last_batch_time
             if len(self.frame_buffer) >= self.batch_size and time_since_last_batch >= self.batch_interval:
-                # Take the most recent batch_size frames
-                batch_frames = self.frame_buffer[-self.batch_size:]
-                batch_settings = self.settings_buffer[-self.batch_size:]
-                
-                # Remove the processed frames
-                self.frame_buffer = self.frame_buffer[:-self.batch_size]
-                self.settings_buffer = self.settings_buffer[:-self.batch_size]
-                
-                # Process the batch
-                batch = torch.stack(batch_frames)
-                batch = batch.to(torch.float32) / 255.0
+                # Take (and remove) the most recent batch_size frames
+                batch_slots, batch_frames = zip(
+                    *[self.frame_buffer.pop() for _ in range(self.batch_size)][::-1]
+                )
+                batch_revisions = [self.settings_buffer.pop() for _ in range(self.batch_size)][::-1]
+                batch_settings = [self.settings_snapshots[r] for r in batch_revisions]
+
+                # Forget snapshots that no buffered frame refers to anymore
+                live_revisions = set(self.settings_buffer)
+                live_revisions.add(revision)
+                for stale in self.settings_snapshots.keys() - live_revisions:
+                    del self.settings_snapshots[stale]
                 
-                self.output_queue.put((batch, batch_settings))
+                # Drop the oldest batches rather than let the processor fall behind
+                while self.output_queue.qsize() >= self.max_queue_size or not self.free_batches:
+                    try:
+                        _, _, release = self.output_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    release()
+                with self.batch_lock:
+                    if not self.free_batches:
+                        # Every slot is still being read, skip this batch
+                        self.free_slots.extend(batch_slots)
+                        return True
+                    index = self.free_batches.popleft()
+                ring = self.batch_ring
+
+                # Process the batch once the uploads have landed
+                batch = ring[index]
+                torch.cuda.current_stream().wait_stream(self.copy_stream)
+                torch.stack(batch_frames, out=batch)
+                self.stack_event.record()
+                # The stack has been queued, later uploads wait on stack_event before reusing these
+                self.free_slots.extend(batch_slots)
+
+                self.output_queue.put(
+                    (batch, batch_settings, functools.partial(self.release_batch, ring, index))
+                )
                 self.last_batch_time = current_time
 
         except Exception as e:
@@ -105,6 +237,23 @@ class ThreadedWebsocket(ThreadedWorker):
             return False
         return True
 
+    async def consume_frames(self, websocket, frames):
+        """Process the latest frame from a connection, at most once per frame_interval"""
+        processor_state = self.frame_processors[websocket]
+        while True:
+            message = await frames.get()
+            try:
+                current_time = time.time()
+                await self.process_frame(websocket, message)
+                processor_state['last_frame_time'] = current_time
+                processor_state['frames_processed'] += 1
+            except Exception as e:
+                print(f"Error handling message: {e}")
+
+            # Allow 10% variance, frames arriving meanwhile replace each other
+            elapsed = time.time() - processor_state['last_frame_time']
+            await asyncio.sleep(max(0, self.frame_interval * 0.9 - elapsed))
+
     async def handler(self, websocket, path):
         """Handle a single WebSocket connection"""
         try:
@@ -130,36 +279,28 @@ class ThreadedWebsocket(ThreadedWorker):
                     'frames_processed': 0
                 }
             
-            print(f"WebSocket connection opened. Active connections: {len(self.active_connections)}")
+            logger.debug("WebSocket connection opened. Active connections: %d", len(self.active_connections))
             
+            # Only the newest frame is worth processing, older ones are dropped
+            frames = asyncio.Queue(maxsize=1)
+            consumer = asyncio.create_task(self.consume_frames(websocket, frames))
             try:
                 async for message in websocket:
-                    try:
-                        # Handle heartbeat
-                        if message == 'pong':
-                            self.last_heartbeat[websocket] = time.time()
-                            continue
-
-                        # Process frame
-                        current_time = time.time()
-                        processor_state = self.frame_processors[websocket]
-                        
-                        # Rate limiting check
-                        time_since_last = current_time - processor_state['last_frame_time']
-                        if time_since_last < self.frame_interval * 0.9:  # Allow 10% variance
-                            continue
-                            
-                        await self.process_frame(websocket, message)
-                        processor_state['last_frame_time'] = current_time
-                        processor_state['frames_processed'] += 1
-
-                    except Exception as e:
-                        print(f"Error handling message: {e}")
-                        await asyncio.sleep(0.1)
+                    # Handle heartbeat
+                    if message == 'pong':
+                        self.last_heartbeat[websocket] = time.time()
                         continue
 
+                    try:
+                        frames.put_nowait(message)
+                    except asyncio.QueueFull:
+                        frames.get_nowait()
+                        frames.put_nowait(message)
+
             except websockets.exceptions.ConnectionClosed:
-                print("Connection closed normally")
+                logger.debug("Connection closed normally")
+            finally:
+                consumer.cancel()
         except Exception as e:
             print(f"Connection error: {e}")
         finally:
@@ -168,20 +309,22 @@ class ThreadedWebsocket(ThreadedWorker):
                 self.authenticated_connections.discard(websocket)
                 self.last_heartbeat.pop(websocket, None)
                 self.frame_processors.pop(websocket, None)
-            print(f"WebSocket connection closed. Remaining connections: {len(self.active_connections)}")
+            logger.debug("WebSocket connection closed. Remaining connections: %d", len(self.active_connections))
 
     async def broadcast_to_all(self, data):
         if not self.active_connections:
             return
 
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *[websocket.send(data) for websocket in connections], return_exceptions=True
+        )
+
         disconnected = set()
-        for websocket in self.active_connections:
-            try:
-                await websocket.send(data)
-            except websockets.exceptions.ConnectionClosed:
-                disconnected.add(websocket)
-            except Exception as e:
-                print(f"Error broadcasting to client: {e}")
+        for websocket, result in zip(connections, results):
+            if isinstance(result, Exception):
+                if not isinstance(result, websockets.exceptions.ConnectionClosed):
+                    print(f"Error broadcasting to client: {result}")
                 disconnected.add(websocket)
 
         # Clean up disconnected clients
@@ -192,6 +335,22 @@ class ThreadedWebsocket(ThreadedWorker):
     async def send_data(self, data):
         await self.broadcast_to_all(data)
 
+    def queue_broadcast(self, data):
+        """Thread-safe: hand a frame to the broadcast task without waiting on the send"""
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.put_broadcast, data)
+
+    def put_broadcast(self, data):
+        # Drop the oldest frame if the clients can't keep up
+        if self.broadcast_queue.full():
+            self.broadcast_queue.get_nowait()
+        self.broadcast_queue.put_nowait(data)
+
+    async def broadcast_frames(self):
+        while True:
+            data = await self.broadcast_queue.get()
+            await self.broadcast_to_all(data)
+
     def setup(self):
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
@@ -199,6 +358,8 @@ class ThreadedWebsocket(ThreadedWorker):
         self.server = self.loop.run_until_complete(
             serve(self.handler, "0.0.0.0", self.ws_port)
         )
+        self.broadcast_queue = asyncio.Queue(maxsize=self.batch_size)
+        self.loop.create_task(self.broadcast_frames())
         print(f"WebSocket server started on port {self.ws_port}")
 
     def work(self):
@@ -261,6 +422,7 @@ class ThreadedWebsocket(ThreadedWorker):
         print("ThreadedWebsocket closing")
         self.stop_event.set()
         self.loop.call_soon_threadsafe(self.cleanup)
+        self.decode_pool.shutdown(wait=False)
         super().close()
 
 
@@ -270,7 +432,9 @@ class Processor(ThreadedWorker):
         self.batch_size = settings.batch_size
         self.settings = settings
         print("Settings1:", settings)
-        self.jpeg = TurboJPEG()
+        self.encode_pool = ThreadPoolExecutor(
+            max_workers=min(8, os.cpu_count()), thread_name_prefix="jpeg_encoder"
+        )
         self.use_cached = use_cached
         self.max_queue_size = settings.batch_size * 2  # Store up to 2 batches worth of frames
 
@@ -294,31 +458,85 @@ class Processor(ThreadedWorker):
         load_file_from_url(model_url, weights_dir)
         print("Model downloaded successfully")
             
-        self.upscaler = RealESRGANer(
-            scale=2,
-            model_path=os.path.join(weights_dir, 'RealESRGAN_x2plus.pth'),
-            model=model,
-            half=True,
-            tile=512,
-            tile_pad=32,
-            pre_pad=0,
-            device='cuda'
-        )
+        # Run RRDBNet directly: a 512x512 frame fits in a single tile, so the
+        # RealESRGANer tiling loop and per-frame numpy roundtrip are pure overhead
+        weights = torch.load(os.path.join(weights_dir, 'RealESRGAN_x2plus.pth'), map_location="cpu")
+        key = "params_ema" if "params_ema" in weights else "params"
+        model.load_state_dict(weights[key], strict=True)
+        self.upscaler_net = model.half().to("cuda").eval()
+        # The whole upscale stage is captured in one CUDA graph below, so the
+        # network itself is compiled without torch.compile's own cudagraphs
+        self.upscaler_net = torch.compile(self.upscaler_net, fullgraph=True)
+        self.outscale = 2.109375  # Scale from 512 to 1080
+        self.upscale_graph = None
+        self.upscale_input = None
+        self.upscale_output = None
         print("Upscaler initialized")
 
         self.clear_input()  # drop old frames
         self.runs = 0
 
+    def upscale_step(self, results):
+        """Upscale, resize and quantize a (B, C, H, W) batch to (B, H, W, C) uint8"""
+        upscaled = self.upscaler_net(results)
+        height, width = results.shape[-2:]
+        upscaled = F.interpolate(
+            upscaled,
+            size=(round(height * self.outscale), round(width * self.outscale)),
+            mode="bilinear",
+            align_corners=False,
+        )
+        return (upscaled.clamp_(0, 1) * 255).to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+
+    def capture_upscale(self, shape):
+        print(f"Capturing upscale graph for {tuple(shape)}")
+        self.upscale_input = torch.zeros(shape, dtype=torch.float16, device="cuda")
+
+        # Warm up on a side stream so compilation and autotuning stay out of the capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), torch.inference_mode():
+            for _ in range(2):
+                self.upscale_step(self.upscale_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.upscale_graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.upscale_graph), torch.inference_mode():
+            self.upscale_output = self.upscale_step(self.upscale_input)
+
+    def upscale(self, results):
+        """Run the upscale stage by replaying a single captured CUDA graph"""
+        if self.upscale_graph is None or self.upscale_input.shape != results.shape:
+            self.capture_upscale(results.shape)
+        self.upscale_input.copy_(results)
+        self.upscale_graph.replay()
+        return self.upscale_output.cpu().numpy()
+
     def work(self, args):
-        # Process only if we're not too backed up
-        while self.input_queue.qsize() > self.max_queue_size:
-            # Drop old frames if we're getting backed up
+        images, settings_batch, release = args
+        try:
+            self.process_batch(images)
+        finally:
+            # The frames have been read, their ring slot can take a new batch
+            release()
+
+        self.runs += 1
+        if self.runs < 3:
+            print("warming up, dropping old frames")
+            self.drop_input()
+
+    def drop_input(self, keep=0):
+        """Drop queued batches, oldest first, handing their ring slots back"""
+        while self.input_queue.qsize() > keep:
             try:
-                _ = self.input_queue.get_nowait()
-            except:
+                _, _, release = self.input_queue.get_nowait()
+            except queue.Empty:
                 break
+            release()
 
-        images, settings_batch = args
+    def process_batch(self, images):
+        # Process only if we're not too backed up
+        self.drop_input(keep=self.max_queue_size)
 
         results = self.diffusion_processor.run(
             images=images,
@@ -329,17 +547,13 @@ class Processor(ThreadedWorker):
             seed=self.settings.seed,
         )
 
-        for frame_settings, image, result in zip(settings_batch, images, results):
-            # Upscale the result to 1080p
-            result_uint8 = (result * 255).astype(np.uint8)
-            upscaled, _ = self.upscaler.enhance(result_uint8, outscale=2.109375)  # Scale from 512 to 1080
-            result_bytes = self.jpeg.encode(upscaled, pixel_format=TJPF_RGB)
-            self.output_queue.put(result_bytes)
-        
-        self.runs += 1
-        if self.runs < 3:
-            print("warming up, dropping old frames")
-            self.clear_input()
+        # Upscale the whole batch to 1080p on the GPU
+        upscaled_batch = self.upscale(results)
+
+        # Encode frames in parallel, forwarding each in order as soon as it's ready
+        futures = [self.encode_pool.submit(encode_frame, upscaled) for upscaled in upscaled_batch]
+        for future in futures:
+            self.output_queue.put(future.result())
 
 
 class BroadcastStream(ThreadedWorker):
@@ -358,12 +572,9 @@ class BroadcastStream(ThreadedWorker):
     def broadcast_msg(self, jpg):
         try:
             if self.threaded_websocket is not None:
-                future = asyncio.run_coroutine_threadsafe(
-                    self.threaded_websocket.send_data(jpg), self.threaded_websocket.loop
-                )
-                future.result()  # Wait for the coroutine to complete
+                self.threaded_websocket.queue_broadcast(jpg)
             else:
-                print("No active WebSocket connection")
+                logger.debug("No active WebSocket connection")
         except Exception as e:
             print(f"Error in broadcast_msg: {e}")
 
@@ -375,7 +586,7 @@ class BroadcastStream(ThreadedWorker):
             if self.threaded_websocket is not None:
                 self.broadcast_msg(frame)
             else:
-                print("No active WebSocket connection")
+                logger.debug("No active WebSocket connection")
         except Exception as e:
             print(f"Error in work: {e}")
 
@@ -494,6 +705,14 @@ def main():
 
 
 if __name__ == "__main__":
+    # Handlers write from a listener thread, so logging never blocks a request or a frame
     config = load_server_config()
+    log_queue = queue.Queue()
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    logging.basicConfig(
+        level=config.LOG_LEVEL.upper(), handlers=[logging.handlers.QueueHandler(log_queue)]
+    )
+    log_listener.start()
+    atexit.register(log_listener.stop)
     print(f"Server password configured: {bool(config.SERVER_PASSWORD)}")
     main()
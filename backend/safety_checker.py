@@ -1,35 +1,241 @@
-from transformers import pipeline, AutoTokenizer, AutoModelForSequenceClassification
 import torch
 from typing import Tuple
-import time
-from functools import lru_cache
+import asyncio
+import os
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+
+MODEL_ID = "facebook/roberta-hate-speech-dynabench-r4-target"
+ONNX_DIR = "./saved_pipeline/roberta-hate-speech-onnx"
+
+# Inputs are padded up to these shapes so the compiled graphs get reused
+BATCH_BUCKETS = (1, 4, 16)
+# Longer inputs are truncated, the start of a prompt is enough to classify it
+LENGTH_BUCKETS = (16, 32, 64)
 
 
 class SafetyChecker:
-    def __init__(self):
-        # Initialize local model
-        self.tokenizer = AutoTokenizer.from_pretrained("facebook/roberta-hate-speech-dynabench-r4-target")
-        self.model = AutoModelForSequenceClassification.from_pretrained("facebook/roberta-hate-speech-dynabench-r4-target")
-        self.classifier = pipeline(
-            "text-classification",
-            model=self.model,
-            tokenizer=self.tokenizer,
-            device=0 if torch.cuda.is_available() else -1
-        )
-        self.cache = {}
+    def __init__(self, backend="torch", int8=False):
+        self.backend = backend
+        self.int8 = int8
+        # The model is loaded on first use, or ahead of it by preload
+        self.tokenizer = None
+        self.model = None
+        self.compiled = None
+        self.device = None
+        self.stream = None
+        self.id2label = None
+        self.load_lock = threading.Lock()
         self.cache_ttl = 3600  # Cache results for 1 hour
+        self.cache = TTLCache(maxsize=1000, ttl=self.cache_ttl)
+
+        # Concurrent submissions are gathered into one classifier call
+        self.max_batch = 16
+        self.max_delay = 0.01  # seconds to wait for more requests
+        self.requests = asyncio.Queue()
+        # Forward passes run here so they never block the server's event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="safety")
+
+    def preload(self):
+        """Start loading the model on the safety thread without waiting for it"""
+        self.executor.submit(self.load)
+
+    def load(self):
+        """Load, compile and warm up the classifier, once"""
+        with self.load_lock:
+            if self.model is not None:
+                return
+
+            # transformers is only imported once the classifier is actually needed
+            from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+            # Initialize local model
+            self.tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+            model = None
+            if self.backend in ("onnx", "tensorrt"):
+                model = self.load_onnx(self.backend, self.int8)
+            if model is None and self.int8 and torch.cuda.is_available():
+                model = self.load_int8_cuda()
+            if model is None:
+                device = "cuda" if torch.cuda.is_available() else "cpu"
+                model = AutoModelForSequenceClassification.from_pretrained(
+                    MODEL_ID, torch_dtype=self.model_dtype()
+                ).to(device).eval()
+                if self.int8 and device == "cpu":
+                    model = torch.quantization.quantize_dynamic(
+                        model, {torch.nn.Linear}, dtype=torch.qint8
+                    )
+                    print("Safety classifier quantized to INT8")
+                if device == "cuda":
+                    self.compiled = torch.compile(
+                        model, mode="reduce-overhead", fullgraph=True, dynamic=False
+                    )
+            self.device = model.device
+            if self.device.type == "cuda":
+                # A stream of its own, so checks overlap the diffusion kernels instead of queueing behind them
+                self.stream = torch.cuda.Stream(device=self.device)
+            self.id2label = model.config.id2label
+            if self.compiled is not None:
+                self.warmup_buckets()
+
+            # Publishing the model last means a half-loaded checker is never used
+            self.model = model
+            if self.compiled is None:
+                # The first call pays for lazy initialisation, keep it off the first prompt
+                self.predict(["warmup"])
+
+    @staticmethod
+    def model_dtype():
+        """Half precision where the GPU has tensor cores for it, fp32 otherwise"""
+        if not torch.cuda.is_available():
+            return torch.float32
+        major, _ = torch.cuda.get_device_capability()
+        if major >= 8:
+            # Ampere and newer, bf16 is as fast as fp16 with fp32's range
+            return torch.bfloat16
+        if major >= 7:
+            return torch.float16
+        return torch.float32
+
+    def warmup_buckets(self):
+        """Compile and capture every bucket shape up front"""
+        print("Compiling safety classifier")
+        with self.on_stream(), torch.inference_mode():
+            for batch_size in BATCH_BUCKETS:
+                for length in LENGTH_BUCKETS:
+                    input_ids = torch.full(
+                        (batch_size, length), self.tokenizer.bos_token_id, device="cuda"
+                    )
+                    attention_mask = torch.ones_like(input_ids)
+                    # CUDA graphs are recorded after a couple of warm runs
+                    for _ in range(3):
+                        self.compiled(input_ids=input_ids, attention_mask=attention_mask)
+        self.stream.synchronize()
+        print("Safety classifier compiled")
 
-    def _clean_cache(self):
-        """Remove expired cache entries"""
-        current_time = time.time()
-        expired_keys = [
-            k for k, (_, timestamp) in self.cache.items()
-            if current_time - timestamp > self.cache_ttl
+    def on_stream(self):
+        """Run the enclosed GPU work on the classifier's own stream"""
+        return torch.cuda.stream(self.stream) if self.stream is not None else nullcontext()
+
+    def predict(self, texts):
+        """Tokenize and classify texts, returning a (label, score) pair per text"""
+        encoded = self.tokenizer(texts, truncation=True, max_length=LENGTH_BUCKETS[-1])["input_ids"]
+
+        # Group texts of similar length so each forward pads as little as possible
+        buckets = {}
+        for index in sorted(range(len(texts)), key=lambda i: len(encoded[i])):
+            length = next(b for b in LENGTH_BUCKETS if b >= len(encoded[index]))
+            buckets.setdefault(length, []).append(index)
+
+        results = [None] * len(texts)
+        for length, indices in buckets.items():
+            sub_batch = {"input_ids": [encoded[i] for i in indices]}
+            for index, result in zip(indices, self.forward(sub_batch, length)):
+                results[index] = result
+        return results
+
+    def forward(self, encoded, length):
+        """Classify one sub-batch whose items all fit within length tokens"""
+        num_texts = len(encoded["input_ids"])
+        if self.compiled is None:
+            inputs = self.tokenizer.pad(encoded, padding="longest", return_tensors="pt")
+            input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+            model = self.model
+        else:
+            # Pad up to the bucket so a captured graph can be replayed
+            inputs = self.tokenizer.pad(
+                encoded, padding="max_length", max_length=length, return_tensors="pt"
+            )
+            input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+
+            # Fill the batch with copies of the last row, their results are dropped
+            batch_size = next((b for b in BATCH_BUCKETS if b >= num_texts), num_texts)
+            if batch_size > num_texts:
+                extra = batch_size - num_texts
+                input_ids = torch.cat([input_ids, input_ids[-1:].expand(extra, -1)])
+                attention_mask = torch.cat([attention_mask, attention_mask[-1:].expand(extra, -1)])
+            model = self.compiled
+
+        with self.on_stream(), torch.inference_mode():
+            logits = model(
+                input_ids=input_ids.to(self.device),
+                attention_mask=attention_mask.to(self.device),
+            ).logits
+            scores, labels = logits[:num_texts].float().softmax(-1).max(-1)
+            # tolist waits on this stream only, not on the diffusion work
+            labels, scores = labels.tolist(), scores.tolist()
+        return [
+            (self.id2label[label], score)
+            for label, score in zip(labels, scores)
         ]
-        for k in expired_keys:
-            del self.cache[k]
 
-    @lru_cache(maxsize=1000)
+    def load_int8_cuda(self):
+        """Load the classifier with bitsandbytes INT8 linear layers"""
+        from transformers import AutoModelForSequenceClassification
+
+        try:
+            import bitsandbytes  # noqa: F401
+        except ImportError as e:
+            print(f"bitsandbytes unavailable, keeping the half precision classifier: {e}")
+            return None
+        model = AutoModelForSequenceClassification.from_pretrained(
+            MODEL_ID, load_in_8bit=True, device_map="auto"
+        ).eval()
+        print("Safety classifier loaded in INT8")
+        return model
+
+    def load_onnx(self, backend, int8=False):
+        """Load the classifier as an ONNX Runtime session, exporting it on first use"""
+        try:
+            from optimum.onnxruntime import ORTModelForSequenceClassification
+        except ImportError as e:
+            print(f"ONNX Runtime unavailable, using the PyTorch classifier: {e}")
+            return None
+
+        if not torch.cuda.is_available():
+            provider, provider_options = "CPUExecutionProvider", None
+        elif backend == "tensorrt":
+            # TensorRT builds fp16 engines on first run and caches them next to the model
+            provider = "TensorrtExecutionProvider"
+            provider_options = {
+                "trt_fp16_enable": True,
+                "trt_engine_cache_enable": True,
+                "trt_engine_cache_path": os.path.join(ONNX_DIR, "trt_cache"),
+            }
+        else:
+            provider, provider_options = "CUDAExecutionProvider", None
+
+        exported = os.path.exists(os.path.join(ONNX_DIR, "model.onnx"))
+        model = ORTModelForSequenceClassification.from_pretrained(
+            ONNX_DIR if exported else MODEL_ID,
+            export=not exported,
+            provider=provider,
+            provider_options=provider_options,
+        )
+        if not exported:
+            model.save_pretrained(ONNX_DIR)
+
+        # TensorRT needs calibrated INT8, dynamic quantization only suits ONNX Runtime
+        if int8 and backend == "onnx":
+            quantized = os.path.join(ONNX_DIR, "model_quantized.onnx")
+            if not os.path.exists(quantized):
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+
+                quantize_dynamic(
+                    os.path.join(ONNX_DIR, "model.onnx"), quantized, weight_type=QuantType.QInt8
+                )
+            model = ORTModelForSequenceClassification.from_pretrained(
+                ONNX_DIR,
+                file_name="model_quantized.onnx",
+                provider=provider,
+                provider_options=provider_options,
+            )
+            print("Safety classifier quantized to INT8")
+        print(f"Safety classifier running on ONNX Runtime ({provider})")
+        return model
+
     def __call__(self, text: str) -> Tuple[str, str]:
         """Check if content is safe and return detailed categorization
         
@@ -41,31 +247,72 @@ class SafetyChecker:
                 - The safety result ("safe" or "unsafe")
                 - A detailed message about the classification
         """
-        self._clean_cache()
-
         # Check cache first
-        if text in self.cache:
-            return self.cache[text][0], "cached"
+        verdict = self.cache.get(text)
+        if verdict is not None:
+            return verdict
+
+        verdicts = self.classify([text])
+        self.remember([text], verdicts)
+        return verdicts[0]
 
+    def classify(self, texts):
+        """Classify a list of texts in a single forward pass"""
         try:
+            self.load()
             # Use local model for classification
-            result = self.classifier(text)[0]
-            is_safe = result['label'] == 'nothate'
-            confidence = result['score']
-            
-            # Cache the result
-            self.cache[text] = ("safe" if is_safe else "unsafe", time.time())
-            
-            if is_safe:
-                return "safe", f"Content is appropriate (confidence: {confidence:.2f})"
-            else:
-                return "unsafe", f"Content may be inappropriate (confidence: {confidence:.2f})"
-                
+            results = self.predict(texts)
         except Exception as e:
             print(f"Error in local model classification: {e}")
-            return "safe", "error"
+            return [("safe", "error")] * len(texts)
+
+        verdicts = []
+        for label, confidence in results:
+            is_safe = label == 'nothate'
+
+            if is_safe:
+                verdict = ("safe", f"Content is appropriate (confidence: {confidence:.2f})")
+            else:
+                verdict = ("unsafe", f"Content may be inappropriate (confidence: {confidence:.2f})")
+            verdicts.append(verdict)
+        return verdicts
+
+    def remember(self, texts, verdicts):
+        """Cache fresh verdicts, on the event loop thread so the cache is never shared"""
+        for text, verdict in zip(texts, verdicts):
+            if verdict[1] != "error":
+                self.cache[text] = verdict
+
+    async def submit(self, text: str) -> Tuple[str, str]:
+        """Queue text for the next classifier batch and wait for its result"""
+        # Repeated prompts are answered straight from the cache
+        verdict = self.cache.get(text)
+        if verdict is not None:
+            return verdict
+
+        future = asyncio.get_running_loop().create_future()
+        await self.requests.put((text, future))
+        return await future
+
+    async def run_batcher(self):
+        """Drain submitted texts into batches, meant to run for the life of the server loop"""
+        while True:
+            batch = [await self.requests.get()]
+            # Give concurrent requests a moment to join this batch
+            await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_batch and not self.requests.empty():
+                batch.append(self.requests.get_nowait())
+
+            texts = [text for text, _ in batch]
+            verdicts = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.classify, texts
+            )
+            self.remember(texts, verdicts)
+            for (_, future), verdict in zip(batch, verdicts):
+                if not future.done():
+                    future.set_result(verdict)
 
-    def check_transcription(self, text: str) -> Tuple[bool, str]:
+    async def check_transcription(self, text: str) -> Tuple[bool, str]:
         """Check transcribed text for inappropriate content
         
         Args:
@@ -76,7 +323,9 @@ class SafetyChecker:
                 - Boolean indicating if the content is safe
                 - A message explaining the result
         """
-        result, details = self(text)
+        if not text:
+            return True, "Content is appropriate"
+        result, details = await self.submit(text)
         if result == "unsafe":
             return False, f"Content moderation check failed: {details}"
         return True, "Content is appropriate"
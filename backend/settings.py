@@ -1,7 +1,13 @@
-from pydantic.v1 import BaseSettings, Field
+from pydantic import Field, PrivateAttr
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from typing import Optional
 from config import load_server_config
+import itertools
 import os
 
+# Shared across instances so a copy never reuses a revision number
+_revisions = itertools.count(1)
+
 
 class Settings(BaseSettings):
     # config, cannot be changed
@@ -19,13 +25,16 @@ class Settings(BaseSettings):
     output_port: int = Field(default=5558)
     osc_port: int = Field(default=9091)
     primary_hostname: str = Field(default="0.0.0.0")
-    websocket_port = 8765
-    websocket_address = "ws://0.0.0.0:8765"
+    websocket_port: int = 8765
+    websocket_address: str = "ws://0.0.0.0:8765"
 
     safety: bool = Field(default=False)
+    safety_backend: str = Field(default="torch")  # "torch", "onnx" or "tensorrt"
+    safety_int8: bool = Field(default=False)
     local_files_only: bool = Field(default=False)
-    warmup: str = Field(default=None)
+    warmup: Optional[str] = Field(default=None)
     threaded: bool = Field(default=True)
+    compiler: str = Field(default="sfast")  # "sfast", "torch" or "int8"
 
     # parameters for inference
     prompt: str = Field(default="A psychedelic landscape.")
@@ -51,6 +60,8 @@ class Settings(BaseSettings):
     tint_color_1: tuple = Field(default=(255, 165, 0))  # orange
     tint_color_2: tuple = Field(default=(255, 192, 203))  # pink
 
+    _revision: int = PrivateAttr(default=0)
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         try:
@@ -62,7 +73,19 @@ class Settings(BaseSettings):
             print(f"Error loading server password: {e}")
             raise
 
-    class Config:
-        env_file = ".env"
-        env_file_encoding = "utf-8"
-        case_sensitive = True
+    @property
+    def revision(self):
+        """Increases every time a setting is assigned"""
+        return self._revision
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if not name.startswith("_"):
+            super().__setattr__("_revision", next(_revisions))
+
+    model_config = SettingsConfigDict(
+        env_file=".env",
+        env_file_encoding="utf-8",
+        case_sensitive=True,
+        extra="ignore",
+    )
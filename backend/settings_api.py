@@ -1,22 +1,39 @@
 import threading
+import logging
 import uvicorn
-from fastapi import FastAPI, Request, UploadFile, File, HTTPException, Depends, WebSocket, WebSocketDisconnect
+import uvloop
+from fastapi import FastAPI, Request, UploadFile, File, HTTPException, Depends, Path, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 import aiofiles
 import os
-import tempfile
+import signal
+import hashlib
+import mimetypes
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 import time
 import json
+import orjson
+import re
 import asyncio
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import heapq
+import torch
+from functools import lru_cache
+from typing import Optional, Tuple
+from pydantic import BaseModel, ConfigDict, Field
+from concurrent.futures import TimeoutError
 
 from safety_checker import SafetyChecker
 from speech_processor import SpeechProcessor
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+log = logging.getLogger("settings_api")
+
 banned_words = [
 "Blood", "Bloodbath", "Crucifixion", "Bloody", "Flesh", "Bruises", "Car crash", "Corpse", "Crucified", "Cutting", "Decapitate", "Infested", "Gruesome", "Kill (as in Kill la Kill)", "Infected", "Sadist", "Slaughter", "Teratoma", "Tryphophobia", "Wound", "Cronenberg", "Khorne", "Cannibal", "Cannibalism", "Visceral", "Guts", "Bloodshot", "Gory", "Killing", "Surgery", "Vivisection", "Massacre", "Hemoglobin", "Suicide", "Female Body Parts",
 "Drugs", "Cocaine", "Heroin", "Meth", "Crack",
@@ -25,54 +42,265 @@ banned_words = [
 "Torture", "Disturbing", "Farts", "Fart", "Poop", "Warts", "Xi Jinping", "Shit", "Pleasure", "Errect", "Big Black", "Brown pudding", "Bunghole", "Vomit", "Voluptuous", "Seductive", "Sperm", "Hot", "Sexy", "Sensored", "Censored", "Silenced", "Deepfake", "Inappropriate", "Pus", "Waifu", "mp5", "Succubus", "1488", "Surgery"
 ]
 
+# One automaton for the whole list, a prompt is scanned once whatever the list size
+if ahocorasick is not None:
+    _BANNED_AC = ahocorasick.Automaton()
+    for _word in banned_words:
+        _BANNED_AC.add_word(_word.lower(), _word.lower())
+    _BANNED_AC.make_automaton()
+else:
+    # Without pyahocorasick single words are set lookups on the prompt's words,
+    # only the phrases go through one alternation, longest first so a phrase
+    # wins over a shorter one it starts with
+    _BANNED_AC = None
+    _BANNED_WORDS = frozenset(w.lower() for w in banned_words if w.isalnum())
+    _BANNED_RE = re.compile(
+        r"(?<![^\W_])(?:"
+        + "|".join(
+            re.escape(w.lower())
+            for w in sorted(banned_words, key=len, reverse=True)
+            if not w.isalnum()
+        )
+        + r")(?![^\W_])"
+    )
+    _WORD_RE = re.compile(r"[^\W_]+")
+
+def find_banned_word(prompt: str) -> Optional[str]:
+    """Return the first banned word or phrase in the prompt, matched on whole words"""
+    return _find_banned_word(prompt.lower())
+
+@lru_cache(maxsize=4096)
+def _find_banned_word(text: str) -> Optional[str]:
+    # Retried and re-blended prompts come round often, they skip the scan
+    if _BANNED_AC is None:
+        for word in _WORD_RE.findall(text):
+            if word in _BANNED_WORDS:
+                return word
+        match = _BANNED_RE.search(text)
+        return match.group(0) if match else None
+    for end, word in _BANNED_AC.iter(text):
+        start = end - len(word) + 1
+        if (start == 0 or not text[start - 1].isalnum()) and (
+            end + 1 == len(text) or not text[end + 1].isalnum()
+        ):
+            return word
+    return None
+
+MAX_PROMPT_LENGTH = 2000  # characters
+# Sent as text frames, which is what the clients parse
+_PONG = orjson.dumps({"type": "pong"}).decode()
+VRAM_WARN_FRACTION = 0.9
+
+# Whisper is loaded once per process, however many SettingsAPI instances are made
+_SP_SINGLETON: Optional[SpeechProcessor] = None
+_SP_LOCK = threading.Lock()
+
+class SettingsPatch(BaseModel):
+    """Settings that may be changed together through PATCH /settings"""
+    model_config = ConfigDict(extra="forbid")
+
+    directory: Optional[str] = None
+    debug: Optional[bool] = None
+    compel: Optional[bool] = None
+    passthrough: Optional[bool] = None
+    fixed_seed: Optional[bool] = None
+    mirror: Optional[bool] = None
+    batch_size: Optional[int] = Field(None, ge=1)
+    seed: Optional[int] = Field(None, ge=0)
+    num_inference_steps: Optional[int] = Field(None, ge=1)
+    strength: Optional[float] = Field(None, ge=0.0, le=1.0)
+    opacity: Optional[float] = Field(None, ge=0.0, le=1.0)
+
+def _extract_override(msg: str) -> Tuple[str, bool]:
+    """Split a trailing " -f" safety override flag off a prompt"""
+    s = msg.rstrip()
+    if s.endswith(" -f"):
+        return s[:-3].rstrip(), True
+    if s == "-f":
+        return "", True
+    return msg, False
+
+def load_static(directory):
+    """Read every file under directory into memory, keyed by its URL path"""
+    static = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                content = f.read()
+            key = os.path.relpath(path, directory).replace(os.sep, "/")
+            etag = f'"{hashlib.md5(content).hexdigest()}"'
+            media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            static[key] = (content, etag, media_type)
+    return static
+
+@lru_cache(maxsize=256)
+def blend_prompt(a, b, t):
+    if t == 0:
+        return a
+    elif t == 1:
+        return b
+    return f'("{a}", "{b}").blend({1-t:.2f}, {t:.2f})'
+
 class SettingsAPI:
+    AUDIO_TIMEOUT_S = 30
+    CLIENT_TIMEOUT_S = 60  # WebSocket clients that haven't pinged for this long are closed
+
     def __init__(self, settings):
         self.shutdown = False
         self.settings = settings
-        print(f"Settings API initialized with password configured: {bool(settings.server_password)}")  # Debug line
+        log.debug("Settings API initialized with password configured: %s", bool(settings.server_password))
         port = settings.settings_port
-        self.app = FastAPI()
+        self.app = FastAPI(default_response_class=ORJSONResponse)
         self.security = HTTPBearer()
+        # Load the classifier once, rather than on every checked prompt
+        self.safety_checker = (
+            SafetyChecker(backend=settings.safety_backend, int8=settings.safety_int8)
+            if settings.safety
+            else None
+        )
+        if self.safety_checker is not None:
+            self.safety_checker.preload()
         self.setup_routes()
         self.thread = threading.Thread(target=self.run_server, args=(port,))
-        # Add a thread pool with thread naming for better cleanup
-        self.executor = ThreadPoolExecutor(
-            max_workers=1,
-            thread_name_prefix="audio_processor"
-        )
-        self._transcribing = False  # Lock for transcription
-        self._transcribe_lock = threading.Lock()
+        self._transcribe_sema = asyncio.Semaphore(1)  # One transcription at a time
         self._server = None  # Store server instance
+        self._loop = None  # The server's event loop, the WebSockets belong to it
         self.prompt_0 = settings.prompt
         self.prompt_1 = "A psychedelic landscape."
         self.blend = 0
-        self.speech_processor = SpeechProcessor(device="cuda")
+        self._pending_updates = asyncio.Queue()
+        self._update_debounce = 0.02  # seconds
+        # Typed prompts settle for a moment so a burst re-encodes only its last prompt
+        self._pending_prompts = {}
+        self._prompt_handle = None
+        self._prompt_debounce = 0.1  # seconds
+        # Whisper loads in the background so the other routes are usable straight away
+        self.speech_processor = None
+        self._speech_ready = threading.Event()
+        self._shutdown_event = threading.Event()
+        self._cancel_transcribe = threading.Event()  # Replaced for every transcription
+        threading.Thread(target=self._load_speech, daemon=True).start()
         self.base_prompt = "photorealistic: "
-        self.websocket_clients = set()  # Track connected WebSocket clients
-        self.last_ping_time = {}  # Track last ping time for each client
-        print("Speech processor initialized")
+        self.clients = {}  # id(websocket) -> (websocket, last ping time)
+        # (expiry, client id) for every ping, stale entries are skipped when popped
+        self._expiry_heap = []
+        self._expiry_added = asyncio.Event()
+
+    def _load_speech(self):
+        global _SP_SINGLETON
+        with _SP_LOCK:
+            if _SP_SINGLETON is None:
+                speech_processor = SpeechProcessor(device="cuda", shutdown_event=self._shutdown_event)
+                _SP_SINGLETON = speech_processor
+                log.info("Speech processor initialized")
+            else:
+                log.warning("Speech processor already loaded in this process, sharing it")
+                _SP_SINGLETON.shutdown_event = self._shutdown_event
+        self.speech_processor = _SP_SINGLETON
+        self._speech_ready.set()
+
+        if torch.cuda.is_available():
+            free, total = torch.cuda.mem_get_info()
+            if (total - free) / total > VRAM_WARN_FRACTION:
+                log.warning(
+                    "GPU memory is %.0f%% used, check for duplicate model copies",
+                    100 * (total - free) / total,
+                )
 
     def update_blend(self):
-        if self.blend == 0:
-            self.settings.prompt = self.prompt_0
-        elif self.blend == 1:
-            self.settings.prompt = self.prompt_1
-        else:
-            a = self.prompt_0
-            b = self.prompt_1
-            t = self.blend
-            self.settings.prompt = f'("{a}", "{b}").blend({1-t:.2f}, {t:.2f})'
+        prompt = blend_prompt(self.prompt_0, self.prompt_1, round(self.blend, 2))
+        # Only a real change should bump the settings and re-encode the prompt downstream
+        if prompt != self.settings.prompt:
+            self.settings.prompt = prompt
+
+    def queue_update(self, field, value):
+        """Defer a slider update, only the latest value per field gets applied"""
+        self._pending_updates.put_nowait((field, value))
+
+    def queue_prompt(self, field, prompt):
+        """Debounce a prompt change, restarting the wait on every new prompt"""
+        self._pending_prompts[field] = prompt
+        if self._prompt_handle is not None:
+            self._prompt_handle.cancel()
+        self._prompt_handle = asyncio.get_running_loop().call_later(
+            self._prompt_debounce, self.apply_prompts
+        )
+
+    def apply_prompts(self):
+        """Apply the settled prompts with a single blend update"""
+        self._prompt_handle = None
+        pending, self._pending_prompts = self._pending_prompts, {}
+        for field, prompt in pending.items():
+            setattr(self, field, prompt)
+            log.info("Updated %s: %s", field, prompt)
+        self.update_blend()
+
+    async def apply_updates(self):
+        """Apply queued slider updates in bursts, meant to run for the life of the server loop"""
+        while True:
+            updates = dict([await self._pending_updates.get()])
+            # Let a moving slider settle before touching the settings
+            await asyncio.sleep(self._update_debounce)
+            while not self._pending_updates.empty():
+                field, value = self._pending_updates.get_nowait()
+                updates[field] = value
+
+            for field, value in updates.items():
+                if field == "blend":
+                    self.blend = value
+                    self.update_blend()
+                else:
+                    setattr(self.settings, field, value)
+                log.info("Updated %s: %s", field, value)
+
+    def touch_client(self, websocket):
+        """Record a sign of life from a WebSocket client"""
+        now = time.time()
+        self.clients[id(websocket)] = (websocket, now)
+        heapq.heappush(self._expiry_heap, (now + self.CLIENT_TIMEOUT_S, id(websocket)))
+        self._expiry_added.set()
+
+    async def _close_all_ws(self, reason, clients=None):
+        """Close WebSocket clients, all of them by default, concurrently so one slow client doesn't hold up the rest"""
+        if clients is None:
+            clients = [client for client, _ in self.clients.values()]
+        clients = list(clients)
+        results = await asyncio.gather(
+            *(client.close(code=1000, reason=reason) for client in clients),
+            return_exceptions=True,
+        )
+        for client, result in zip(clients, results):
+            if isinstance(result, Exception):
+                log.warning("Error closing WebSocket client: %s", result)
+            self.clients.pop(id(client), None)
+
+    async def transcribe_windows(self, audio, cancel_event):
+        """Transcribe an audio file or path a few windows at a time"""
+        speech = self.speech_processor
+        windows = await asyncio.to_thread(speech.decode_windows, audio)
+        limit = asyncio.Semaphore(speech.WINDOW_WORKERS)
+        results = [None] * len(windows)
+
+        async def run(index, window):
+            async with limit:
+                results[index] = await asyncio.to_thread(speech.transcribe_window, window, cancel_event)
+
+        await asyncio.gather(*(run(i, w) for i, w in enumerate(windows)))
+        if any(r is None for r in results):
+            return None
+        return speech.join_segments([segment for r in results for segment in r])
 
     def start(self):
-        print("SettingsAPI starting")
+        log.info("SettingsAPI starting")
         if not self.thread.is_alive():
             self.thread.start()
 
-    def verify_token(self, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+    def verify_token(self, credentials: HTTPAuthorizationCredentials):
         """Verify the authentication token"""
-        print(f"Verifying token against password: {bool(self.settings.server_password)}")  # Debug line
+        log.debug("Verifying token against password: %s", bool(self.settings.server_password))
         if not credentials or credentials.credentials != self.settings.server_password:
-            print("Invalid authentication credentials")  # Debug line
+            log.debug("Invalid authentication credentials")
             raise HTTPException(
                 status_code=401,
                 detail="Invalid authentication credentials",
@@ -82,6 +310,11 @@ class SettingsAPI:
 
     def setup_routes(self):
         app = self.app
+
+        async def verify(credentials: HTTPAuthorizationCredentials = Depends(self.security)) -> str:
+            return self.verify_token(credentials)
+        # One shared dependency, so each route parses the bearer header once
+        self._verify = verify
         app.add_middleware(
             CORSMiddleware,
             allow_origins=["*"],
@@ -91,205 +324,178 @@ class SettingsAPI:
         )
 
         @app.post("/prompt/{msg}")
-        async def prompt(msg: str, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
+        async def prompt(msg: str, _: str = Depends(self._verify)):
             prompt = msg
-
-            override = "-f" in prompt
-            if override:
-                prompt = prompt.replace("-f", "").strip()
-            if self.settings.safety and not override:
-                safety_checker = SafetyChecker()
-                safety = safety_checker(prompt)
+            if len(prompt) > MAX_PROMPT_LENGTH:
+                raise HTTPException(status_code=413, detail="Prompt is too long")
+
+            prompt, override = _extract_override(prompt)
+            if self.safety_checker is not None and not override:
+                banned = find_banned_word(prompt)
+                if banned is not None:
+                    log.info("Ignoring prompt (banned word %r): %s", banned, prompt)
+                    return {"safety": "unsafe"}
+                safety, _ = await self.safety_checker.submit(prompt)
                 if safety != "safe":
-                    print(f"Ignoring prompt ({safety}):", prompt)
+                    log.info("Ignoring prompt (%s): %s", safety, prompt)
                     return {"safety": "unsafe"}
 
-            self.prompt_0 = prompt
-            self.update_blend()
-            print("Updated prompt:", prompt)
+            self.queue_prompt("prompt_0", prompt)
             return {"safety": "safe"}
 
         @app.post("/secondprompt/{msg}")
-        async def secondprompt(msg: str, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
+        async def secondprompt(msg: str, _: str = Depends(self._verify)):
             prompt = msg
-
-            override = "-f" in prompt
-            if override:
-                prompt = prompt.replace("-f", "").strip()
-            if self.settings.safety and not override:
-                safety_checker = SafetyChecker()
-                safety = safety_checker(prompt)
+            if len(prompt) > MAX_PROMPT_LENGTH:
+                raise HTTPException(status_code=413, detail="Prompt is too long")
+
+            prompt, override = _extract_override(prompt)
+            if self.safety_checker is not None and not override:
+                banned = find_banned_word(prompt)
+                if banned is not None:
+                    log.info("Ignoring prompt (banned word %r): %s", banned, prompt)
+                    return {"safety": "unsafe"}
+                safety, _ = await self.safety_checker.submit(prompt)
                 if safety != "safe":
-                    print(f"Ignoring prompt ({safety}):", prompt)
+                    log.info("Ignoring prompt (%s): %s", safety, prompt)
                     return {"safety": "unsafe"}
 
-            self.prompt_1 = prompt
-            self.update_blend()
-            print("Updated secondprompt:", prompt)
+            self.queue_prompt("prompt_1", prompt)
             return {"safety": "safe"}
 
         @app.post("/blend/{msg}")
-        async def blend(msg: str, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
-            try:
-                blend_value = float(msg)
-                if 0 <= blend_value <= 1:
-                    self.blend = blend_value
-                    self.update_blend()
-                    return {"status": "success", "blend": self.blend}
-                else:
-                    return {
-                        "status": "error",
-                        "message": "Blend value must be between 0 and 1",
-                    }
-            except ValueError:
-                return {"status": "error", "message": "Invalid blend value"}
+        async def blend(msg: float = Path(ge=0.0, le=1.0), _: str = Depends(self._verify)):
+            self.queue_update("blend", msg)
+            return {"status": "queued", "blend": msg}
 
         @app.get("/directory/{status}")
-        async def directory(status: str, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
+        async def directory(status: str, _: str = Depends(self._verify)):
             self.settings.directory = "data/" + status
-            print("Updated directory status:", self.settings.directory)
+            log.info("Updated directory status: %s", self.settings.directory)
             return {"status": "updated"}
 
         @app.get("/debug/{status}")
-        async def debug(status: bool, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
+        async def debug(status: bool, _: str = Depends(self._verify)):
             self.settings.debug = status
-            print("Updated debug status:", status)
+            log.info("Updated debug status: %s", status)
             return {"status": "updated"}
 
         @app.get("/compel/{status}")
-        async def compel(status: bool, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
+        async def compel(status: bool, _: str = Depends(self._verify)):
             self.settings.compel = status
-            print("Updated compel status:", status)
+            log.info("Updated compel status: %s", status)
             return {"status": "updated"}
 
         @app.get("/passthrough/{status}")
-        async def passthrough(status: bool, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
+        async def passthrough(status: bool, _: str = Depends(self._verify)):
             self.settings.passthrough = status
-            print("Updated passthrough status:", self.settings.passthrough)
+            log.info("Updated passthrough status: %s", self.settings.passthrough)
             return {"status": "updated"}
 
         @app.get("/fixed_seed/{status}")
-        async def fixed_seed(status: bool, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
+        async def fixed_seed(status: bool, _: str = Depends(self._verify)):
             self.settings.fixed_seed = status
-            print("Updated fixed_seed status:", self.settings.fixed_seed)
+            log.info("Updated fixed_seed status: %s", self.settings.fixed_seed)
             return {"status": "updated"}
 
         @app.get("/mirror/{status}")
-        async def mirror(status: bool, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
+        async def mirror(status: bool, _: str = Depends(self._verify)):
             self.settings.mirror = status
-            print("Updated mirror status:", status)
+            log.info("Updated mirror status: %s", status)
             return {"status": "updated"}
 
         @app.get("/batch_size/{value}")
-        async def batch_size(value: int, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
+        async def batch_size(value: int = Path(ge=1), _: str = Depends(self._verify)):
             self.settings.batch_size = value
-            print("Updated batch_size:", self.settings.batch_size)
+            log.info("Updated batch_size: %s", self.settings.batch_size)
             return {"status": "updated"}
 
         @app.get("/seed/{value}")
-        async def seed(value: int, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
-            self.settings.seed = value
-            print("Updated seed:", self.settings.seed)
-            return {"status": "updated"}
+        async def seed(value: int = Path(ge=0), _: str = Depends(self._verify)):
+            self.queue_update("seed", value)
+            return {"status": "queued"}
 
         @app.get("/steps/{value}")
-        async def steps(value: int, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
-            self.settings.num_inference_steps = value
-            print("Updated num_inference_steps:", self.settings.num_inference_steps)
-            return {"status": "updated"}
+        async def steps(value: int = Path(ge=1), _: str = Depends(self._verify)):
+            self.queue_update("num_inference_steps", value)
+            return {"status": "queued"}
 
         @app.get("/strength/{value}")
-        async def strength(value: float, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
-            self.settings.strength = value
-            print("Updated strength:", self.settings.strength)
-            return {"status": "updated"}
+        async def strength(value: float = Path(ge=0.0, le=1.0), _: str = Depends(self._verify)):
+            self.queue_update("strength", value)
+            return {"status": "queued"}
 
         @app.get("/opacity/{value}")
-        async def opacity(value: float, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-            token = self.verify_token(credentials)
-            value = min(max(value, 0), 1)
-            self.settings.opacity = value
-            print("Updated opacity:", self.settings.opacity)
-            return {"status": "updated"}
-
-        def has_excessive_repetition(text: str) -> bool:
-            # Check for repeated phrases of 5 or more words
-            words = text.split()
-            if len(words) < 10:  # Don't check very short phrases
-                return False
-            
-            # Look for repeated sequences
-            for length in range(5, len(words) // 2):
-                for i in range(len(words) - length * 2):
-                    phrase = ' '.join(words[i:i+length])
-                    rest_of_text = ' '.join(words[i+length:])
-                    if rest_of_text.count(phrase) > 1:  # Found same phrase multiple times
-                        return True
-            return False
+        async def opacity(value: float = Path(ge=0.0, le=1.0), _: str = Depends(self._verify)):
+            self.queue_update("opacity", value)
+            return {"status": "queued"}
+
+        @app.patch("/settings")
+        async def patch_settings(patch: SettingsPatch, _: str = Depends(self._verify)):
+            updates = patch.model_dump(exclude_none=True)
+            if "directory" in updates:
+                updates["directory"] = "data/" + updates["directory"]
+            for field, value in updates.items():
+                setattr(self.settings, field, value)
+            log.info("Updated settings: %s", updates)
+            return {"status": "updated", "updated": sorted(updates)}
 
         @app.post("/transcribe")
         async def transcribe(audio: UploadFile = File(...)):
+            speech_ready = await asyncio.to_thread(self._speech_ready.wait, 30)
+            if not speech_ready:
+                raise HTTPException(status_code=503, detail="Speech recognition is not ready yet")
+            if self._transcribe_sema.locked():
+                return {"error": "Already processing audio"}
+
             try:
-                content = await audio.read()
-                print(f"Received audio data of size: {len(content)} bytes")
+                # PyAV reads the spooled upload where it is, no copy to disk
+                log.debug("Received audio upload: %s", audio.filename)
                 
-                # Use our dedicated executor with timeout
-                future = self.executor.submit(self.speech_processor.process_audio, content)
-                transcribed_text = await asyncio.get_event_loop().run_in_executor(
-                    None, future.result, 300  # 30 second timeout
-                )
+                async with self._transcribe_sema:
+                    self._cancel_transcribe = threading.Event()
+                    try:
+                        transcribed_text = await asyncio.wait_for(
+                            self.transcribe_windows(audio.file, self._cancel_transcribe),
+                            timeout=self.AUDIO_TIMEOUT_S,
+                        )
+                    except asyncio.TimeoutError:
+                        # The worker thread can't be interrupted, ask it to give up instead
+                        self._cancel_transcribe.set()
+                        raise HTTPException(status_code=504, detail="Transcription timed out")
                 
                 # Check for inappropriate content using the enhanced safety checker
-                safety_checker = SafetyChecker()
-                is_safe, safety_message = safety_checker.check_transcription(transcribed_text)
-                if not is_safe:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=safety_message
-                    )
+                if self.safety_checker is not None:
+                    is_safe, safety_message = await self.safety_checker.check_transcription(transcribed_text)
+                    if not is_safe:
+                        raise HTTPException(
+                            status_code=400,
+                            detail=safety_message
+                        )
 
                 return {"text": transcribed_text}
 
+            except HTTPException:
+                raise
             except Exception as e:
+                log.exception("transcribe failed")
                 raise HTTPException(status_code=500, detail=str(e))
 
         @app.post("/auth/verify")
-        async def verify_auth(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+        async def verify_auth(_: str = Depends(self._verify)):
             """Verify the authentication token"""
-            try:
-                token = self.verify_token(credentials)
-                return {"status": "authenticated"}
-            except HTTPException:
-                raise HTTPException(
-                    status_code=401,
-                    detail="Invalid authentication credentials",
-                    headers={"WWW-Authenticate": "Bearer"},
-                )
+            return {"status": "authenticated"}
 
         @app.websocket("/ws")
         async def websocket_endpoint(websocket: WebSocket):
             await websocket.accept()
             client_id = id(websocket)
-            self.websocket_clients.add(websocket)
-            self.last_ping_time[client_id] = time.time()
+            self.touch_client(websocket)
             
             try:
                 while True:
                     try:
-                        data = await websocket.receive_json()
+                        data = orjson.loads(await websocket.receive_text())
                         
                         if data.get("type") == "auth":
                             if data.get("password") != self.settings.server_password:
@@ -298,107 +504,117 @@ class SettingsAPI:
                             continue
                             
                         elif data.get("type") == "ping":
-                            self.last_ping_time[client_id] = time.time()
-                            await websocket.send_json({"type": "pong"})
+                            self.touch_client(websocket)
+                            await websocket.send_text(_PONG)
                             continue
                             
                     except WebSocketDisconnect:
                         break
                     except Exception as e:
-                        print(f"WebSocket error: {e}")
+                        log.warning("WebSocket error: %s", e)
                         break
                         
             finally:
-                self.websocket_clients.remove(websocket)
-                self.last_ping_time.pop(client_id, None)
+                self.clients.pop(client_id, None)
                 await websocket.close()
 
         if "READY_WEBHOOK_URL" not in os.environ:
-            app.mount("/", StaticFiles(directory="fe", html=True), name="static")
+            # Registered last so every other route takes precedence
+            self._static = load_static("fe")
+
+            @app.api_route("/{path:path}", methods=["GET", "HEAD"])
+            async def static(path: str, request: Request):
+                key = path.strip("/")
+                entry = self._static.get(key) or self._static.get(f"{key}/index.html".lstrip("/"))
+                if entry is None:
+                    raise HTTPException(status_code=404, detail="Not Found")
+                content, etag, media_type = entry
+                headers = {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+                if request.headers.get("if-none-match") == etag:
+                    return Response(status_code=304, headers=headers)
+                if request.method == "HEAD":
+                    headers["Content-Length"] = str(len(content))
+                    return Response(media_type=media_type, headers=headers)
+                return Response(content, media_type=media_type, headers=headers)
 
     def run_server(self, port):
-        import asyncio
-        loop = asyncio.new_event_loop()
+        # Server.serve() runs on this loop, so it has to be a uvloop one itself
+        loop = uvloop.new_event_loop()
         asyncio.set_event_loop(loop)
+        self._loop = loop
         
         # Add health check task
         async def health_check():
             while not self.shutdown:
                 current_time = time.time()
-                disconnected_clients = []
-                
-                for client in self.websocket_clients:
-                    client_id = id(client)
-                    last_ping = self.last_ping_time.get(client_id, 0)
-                    if current_time - last_ping > 60:  # 1 minute timeout
-                        disconnected_clients.append(client)
-                
-                for client in disconnected_clients:
-                    try:
-                        await client.close(code=1000, reason="Health check timeout")
-                    except Exception as e:
-                        print(f"Error closing client: {e}")
-                    finally:
-                        self.websocket_clients.remove(client)
-                        self.last_ping_time.pop(id(client), None)
-                
-                await asyncio.sleep(30)  # Check every 30 seconds
+                # Only entries that have come due are looked at, newer pings supersede them
+                expired = {}
+                while self._expiry_heap and self._expiry_heap[0][0] <= current_time:
+                    _, client_id = heapq.heappop(self._expiry_heap)
+                    client, last_ping = self.clients.get(client_id, (None, current_time))
+                    if current_time - last_ping > self.CLIENT_TIMEOUT_S:
+                        expired[client_id] = client
+                if expired:
+                    await self._close_all_ws("Health check timeout", expired.values())
+
+                if self._expiry_heap:
+                    await asyncio.sleep(max(1, self._expiry_heap[0][0] - current_time))
+                else:
+                    # Nothing to time out, sleep until a client connects
+                    self._expiry_added.clear()
+                    await self._expiry_added.wait()
         
         config = uvicorn.Config(
             self.app,
             host="0.0.0.0",
             port=port,
             log_level="info",
-            loop="asyncio",
-            access_log=True
+            loop="uvloop",
+            http="httptools",
+            access_log=False
         )
         self._server = uvicorn.Server(config=config)
         
         try:
             # Start health check task
             loop.create_task(health_check())
+            loop.create_task(self.apply_updates())
+            if self.safety_checker is not None:
+                loop.create_task(self.safety_checker.run_batcher())
             loop.run_until_complete(self._server.serve())
         except Exception as e:
-            print(f"Server error: {e}")
+            log.error("Server error: %s", e)
         finally:
             loop.close()
 
     def stop(self):
         self.shutdown = True
-        print("Stopping SettingsAPI...")
-        # First stop accepting new tasks
-        self.executor.shutdown(wait=False)
-        print("Shutting down audio processing executor...")
-        
-        # Force kill any running audio processing threads
-        for thread in threading.enumerate():
-            if thread.name.startswith('audio_processor'):
-                print(f"Forcing audio thread shutdown: {thread.name}")
-                # Force the thread to stop
-                try:
-                    import ctypes
-                    ctypes.pythonapi.PyThreadState_SetAsyncExc(
-                        ctypes.c_long(thread.ident),
-                        ctypes.py_object(SystemExit)
-                    )
-                except Exception as e:
-                    print(f"Error forcing thread shutdown: {e}")
-
-        # Close all WebSocket connections
-        for client in self.websocket_clients:
+        log.info("Stopping SettingsAPI...")
+        # Ask a running transcription to stop early
+        self._shutdown_event.set()
+        self._cancel_transcribe.set()
+
+        # Close all WebSocket connections on the loop that owns them
+        if self._loop is not None and self._loop.is_running():
+            future = asyncio.run_coroutine_threadsafe(
+                self._close_all_ws("Server shutdown"),
+                self._loop,
+            )
             try:
-                asyncio.run(client.close(code=1000, reason="Server shutdown"))
+                future.result(timeout=2)
+            except TimeoutError:
+                future.cancel()
+                log.warning("Timed out closing WebSocket clients")
             except Exception as e:
-                print(f"Error closing WebSocket client: {e}")
-        self.websocket_clients.clear()
-        self.last_ping_time.clear()
+                log.warning("Error closing WebSocket clients: %s", e)
+        self.clients.clear()
 
         if self._server:
             self._server.should_exit = True
-            print("Server shutdown signal sent")
+            log.info("Server shutdown signal sent")
 
     def close(self):
-        print("SettingsAPI closing")
+        log.info("SettingsAPI closing")
         self.stop()  # Ensure stop is called
         
         # Wait for a short time for graceful shutdown
@@ -406,13 +622,11 @@ class SettingsAPI:
         try:
             self.thread.join(timeout=shutdown_timeout)
         except TimeoutError:
-            print("Server thread failed to stop gracefully")
+            log.warning("Server thread failed to stop gracefully")
         
         if self.thread.is_alive():
-            print("Server thread still alive, forcing exit...")
+            log.warning("Server thread still alive, forcing exit...")
             # Force exit if still running
-            import os
-            import signal
             os.kill(os.getpid(), signal.SIGTERM)
 
-        print("SettingsAPI closed")
+        log.info("SettingsAPI closed")
@@ -1,25 +1,62 @@
 import torch
-import torchaudio
+import av
 from faster_whisper import WhisperModel
 import numpy as np
-import io
-import subprocess
-import tempfile
-import os
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+def looks_looped(text: str) -> bool:
+    """Spot Whisper stuck repeating itself, such text deflates to almost nothing"""
+    b = text.encode("utf-8")
+    if len(b) < 64:
+        return False
+    return len(zlib.compress(b, 1)) / len(b) < 0.15
+
 
 class SpeechProcessor:
-    def __init__(self, device="cuda"):
-        # Force CPU for transcription to avoid CUDA/cuDNN issues
-        self.device = "cpu"
-        # Initialize Whisper model on GPU with FasterWhisper implementation
-        self.model = WhisperModel(
-            model_size_or_path="base",
-            device="cpu",  # Use CPU
-            compute_type="float32"  # Use float32 for CPU
-        )
+    WINDOW_S = 5  # seconds of audio per transcription window
+    WINDOW_WORKERS = 2  # windows transcribed at the same time
+
+    def __init__(self, device="cuda", shutdown_event=None):
+        # Checked between segments so a shutdown doesn't wait for the whole clip
+        self.shutdown_event = shutdown_event
+        self.model = None
+        if device == "cuda" and torch.cuda.is_available():
+            try:
+                # INT8 weights with fp16 activations, the fastest CTranslate2 mode on GPU
+                self.model = WhisperModel(
+                    model_size_or_path="base",
+                    device="cuda",
+                    compute_type="int8_float16",
+                    num_workers=self.WINDOW_WORKERS
+                )
+                self.device = "cuda"
+            except Exception as e:
+                # Missing or mismatched CUDA/cuDNN libraries, keep transcription working on CPU
+                print(f"Speech recognition unavailable on GPU, falling back to CPU: {e}")
+        if self.model is None:
+            self.model = WhisperModel(
+                model_size_or_path="base",
+                device="cpu",
+                compute_type="float32",  # Use float32 for CPU
+                num_workers=self.WINDOW_WORKERS
+            )
+            self.device = "cpu"
         self.last_transcription = None
         self.min_confidence = 0.5  # Minimum confidence threshold
-        print("Speech recognition model loaded on CPU")
+        print(f"Speech recognition model loaded on {self.device.upper()}")
+        # Pay for CTranslate2's lazy setup here rather than on the first request
+        self.warmup()
+
+    def warmup(self):
+        """Transcribe a second of silence so the first request doesn't pay for setup"""
+        segments, _ = self.model.transcribe(
+            np.zeros(16000, dtype=np.float32), language="en", beam_size=1
+        )
+        list(segments)
 
     def is_repetitive(self, text):
         """Check if text contains repetitive patterns"""
@@ -32,114 +69,127 @@ class SpeechProcessor:
         if self.last_transcription and text.lower() == self.last_transcription.lower():
             return True
 
-        # Check for word-level repetition patterns
-        for i in range(1, len(words)//2):
-            pattern = words[:i]
-            repetitions = [words[j:j+i] for j in range(0, len(words), i)]
-            if len(repetitions) >= 3 and all(r == pattern for r in repetitions[:-1]):
+        # Check for word-level repetition patterns: the text is a phrase of period
+        # words repeated, bar a partial last chunk, if it equals itself shifted by
+        # period up to the start of that last chunk. Comparing word ids lets NumPy
+        # test each period in one C loop.
+        _, ids = np.unique(words, return_inverse=True)
+        for period in range(1, len(words)//2):
+            chunks = -(-len(words) // period)
+            if chunks < 3:
+                continue
+            end = period * (chunks - 1)
+            if np.array_equal(ids[period:end], ids[:end - period]):
                 return True
-                
+
         return False
 
-    def convert_webm_to_wav(self, webm_data):
-        webm_file = None
-        wav_file = None
-        try:
-            # Create temporary files for conversion
-            with tempfile.NamedTemporaryFile(suffix='.webm', delete=False) as webm_file, \
-                 tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as wav_file:
-                
-                # Write webm data to temp file
-                webm_file.write(webm_data)
-                webm_file.flush()
-                
-                # Convert webm to wav using ffmpeg
-                result = subprocess.run([
-                    'ffmpeg',
-                    '-loglevel', 'error',
-                    '-y',
-                    '-i', webm_file.name,
-                    '-ar', '16000',
-                    '-ac', '1',
-                    '-f', 'wav',
-                    wav_file.name
-                ], capture_output=True, text=True)
-                
-                if result.returncode != 0:
-                    raise RuntimeError(f"FFmpeg conversion failed: {result.stderr}")
-                
-                # Read the converted wav file
-                waveform, sample_rate = torchaudio.load(wav_file.name)
-                # Move to CPU explicitly if needed
-                if waveform.device.type != "cpu":
-                    waveform = waveform.cpu()
-                
-                return waveform, sample_rate
-        finally:
-            # Clean up temp files
-            try:
-                if webm_file and os.path.exists(webm_file.name):
-                    os.unlink(webm_file.name)
-                if wav_file and os.path.exists(wav_file.name):
-                    os.unlink(wav_file.name)
-            except OSError as e:
-                print(f"Warning: Failed to clean up temp files: {e}")
-
-    def process_audio(self, audio_data, sample_rate=16000):
+    def decode_audio(self, source, sample_rate=16000):
+        """Decode an audio file, path or file object, to mono float32 samples in [-1, 1]"""
+        # Decoding in process avoids an ffmpeg fork and a wav round trip through disk,
+        # and resampling straight to float32 mono hands Whisper its input with no conversion
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=sample_rate)
+        chunks = []
+        with av.open(source) as container:
+            for frame in container.decode(audio=0):
+                chunks.extend(f.to_ndarray().ravel() for f in resampler.resample(frame))
+            # Flush the samples the resampler is still holding on to
+            chunks.extend(f.to_ndarray().ravel() for f in resampler.resample(None))
+        if not chunks:
+            return np.zeros(0, dtype=np.float32), sample_rate
+        return np.concatenate(chunks), sample_rate
+
+    def split_windows(self, samples, sample_rate=16000):
+        """Cut samples into windows of about WINDOW_S seconds, at the quietest point near each boundary"""
+        size = int(self.WINDOW_S * sample_rate)
+        hop = sample_rate // 50  # 20ms energy frames
+        search = sample_rate // 2  # look up to half a second either side of a boundary
+        windows = []
+        start = 0
+        while len(samples) - start > size + search:
+            low = start + size - search
+            region = samples[low:low + 2 * search]
+            frames = len(region) // hop
+            energy = np.square(region[:frames * hop].reshape(frames, hop)).sum(axis=1)
+            # Cutting in a pause keeps words whole without overlapping the windows
+            cut = low + int(energy.argmin()) * hop
+            windows.append(samples[start:cut])
+            start = cut
+        windows.append(samples[start:])
+        return windows
+
+    def decode_windows(self, source, sample_rate=16000):
+        """Decode an audio file and split it into transcription windows"""
+        samples, sample_rate = self.decode_audio(source, sample_rate)
+        print(f"Audio decoded: shape={samples.shape}, sample_rate={sample_rate}")
+        return self.split_windows(samples, sample_rate)
+
+    def is_cancelled(self, cancel_event=None):
+        if self.shutdown_event is not None and self.shutdown_event.is_set():
+            print("Transcription cancelled by shutdown")
+            return True
+        if cancel_event is not None and cancel_event.is_set():
+            print("Transcription cancelled after timing out")
+            return True
+        return False
+
+    def transcribe_window(self, samples, cancel_event=None):
+        """Transcribe one window to its confident (text, probability) segments, None if cancelled"""
+        # Greedy decoding is accurate enough for short spoken prompts, and not
+        # conditioning on earlier text stops Whisper looping on its own output
+        segments, info = self.model.transcribe(
+            samples,
+            beam_size=1,
+            language="en",
+            temperature=0.0,
+            vad_filter=True,
+            vad_parameters={"min_silence_duration_ms": 500},
+            condition_on_previous_text=False
+        )
+
+        results = []
+        for segment in segments:
+            if self.is_cancelled(cancel_event):
+                return None
+            if segment.avg_logprob > -1:  # Filter out very low confidence segments
+                results.append((segment.text, np.exp(segment.avg_logprob)))  # Convert log prob to probability
+        return results
+
+    def join_segments(self, segments):
+        """Combine the segments of every window into the final transcript, None if it is rejected"""
+        if not segments:
+            print("❌ No valid segments found")
+            return None
+
+        text = "".join(" " + segment for segment, _ in segments).strip()
+        avg_confidence = sum(confidence for _, confidence in segments) / len(segments)
+
+        print(f"Transcription complete: '{text}' (confidence: {avg_confidence:.2f})")
+
+        # Check for repetitive patterns and confidence threshold, the deflate
+        # ratio catches character level loops in a single C call first
+        if looks_looped(text) or self.is_repetitive(text):
+            print("❌ Rejected: Repetitive text detected")
+            return None
+
+        self.last_transcription = text
+        return text
+
+    def process_audio(self, audio_path, cancel_event=None, sample_rate=16000):
         try:
             print("Starting audio processing...")
-            # Convert webm to wav
-            waveform, sample_rate = self.convert_webm_to_wav(audio_data)
-            print(f"Audio converted to wav: shape={waveform.shape}, sample_rate={sample_rate}")
-            
-            # Convert to mono if stereo
-            if waveform.shape[0] > 1:
-                waveform = torch.mean(waveform, dim=0, keepdim=True)
-                print("Converted stereo to mono")
-
-            # Convert to numpy array
-            audio_np = waveform.squeeze().numpy()
-            print(f"Converted to numpy array: shape={audio_np.shape}")
+            windows = self.decode_windows(audio_path, sample_rate)
 
             # Transcribe with Whisper
             print("Starting transcription...")
-            segments, info = self.model.transcribe(
-                audio_np,
-                beam_size=5,
-                language="en",
-                temperature=0.0
-            )
-
-            # Combine all segments and check confidence
-            text = ""
-            avg_confidence = 0.0
-            segment_count = 0
-            
-            for segment in segments:
-                if segment.avg_logprob > -1:  # Filter out very low confidence segments
-                    text += " " + segment.text
-                    avg_confidence += np.exp(segment.avg_logprob)  # Convert log prob to probability
-                    segment_count += 1
-            
-            if segment_count > 0:
-                text = text.strip()
-                avg_confidence = avg_confidence / segment_count
-                
-                print(f"Transcription complete: '{text}' (confidence: {avg_confidence:.2f})")
-                
-                # Check for repetitive patterns and confidence threshold
-                if self.is_repetitive(text):
-                    print("❌ Rejected: Repetitive text detected")
+            segments = []
+            for window in windows:
+                window_segments = self.transcribe_window(window, cancel_event)
+                if window_segments is None:
                     return None
-                
-                self.last_transcription = text
-                return text.strip()
-            else:
-                print("❌ No valid segments found")
-                return None
+                segments.extend(window_segments)
+            return self.join_segments(segments)
 
         except Exception as e:
-            print(f"❌ Error processing audio: {e}")
-            import traceback
-            traceback.print_exc()
-            return None 
\ No newline at end of file
+            logger.exception("❌ Error processing audio: %s", e)
+            return None